@@ -4,66 +4,220 @@ import aiofiles.os
 import aiofiles
 import chevron
 import aiohttp
-import json
+import hashlib
 from datetime import datetime
 from collections import defaultdict
-from typing import List
+from pathlib import Path
 
-def version_ordering(a: List[int], b: List[int]):
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    import json
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+ETAG_CACHE_DIR = '.etag_cache'
+ETAG_CACHE_INDEX = os.path.join(ETAG_CACHE_DIR, 'etag_cache.json')
+RELEASES_QUERY = '''
+query($cursor: String, $per_page: Int!) {
+  repository(owner: "AaronLi", name: "Arduino-Boards") {
+    releases(first: $per_page, after: $cursor, orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        isDraft
+        releaseAssets(first: 100) {
+          nodes { name downloadUrl size }
+        }
+      }
+    }
+  }
+}
+'''
+
+async def load_etag_cache():
+    """
+    Loads the ETag cache persisted by a previous run.
+
+    Returns:
+        dict: A dictionary mapping request urls to their ETag and cached body path.
+    """
+    await aiofiles.os.makedirs(ETAG_CACHE_DIR, exist_ok=True)
+    try:
+        async with aiofiles.open(ETAG_CACHE_INDEX, 'rb') as cache_f:
+            return json_loads(await cache_f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+async def save_etag_cache(etag_cache: dict):
+    """
+    Persists the ETag cache for the next run.
+
+    Args:
+        etag_cache (dict): The ETag cache to persist.
+    """
+    async with aiofiles.open(ETAG_CACHE_INDEX, 'wb') as cache_f:
+        await cache_f.write(json_dumps(etag_cache))
+
+async def cached_get(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, etag_cache: dict, url: str):
+    """
+    Performs a conditional GET request, reusing the cached body when the server responds with 304 Not Modified.
+
+    If-None-Match is only sent when the cached body is on disk, a 304 whose cached body can't be read falls back to a
+    plain GET.
+
+    Args:
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+        etag_cache (dict): The ETag cache, updated in place when a new body is received.
+        url (str): The url to retrieve.
+
+    Returns:
+        bytes: The undecoded response body.
+    """
+    headers = {}
+    cache_entry = etag_cache.get(url)
+    if cache_entry is not None and await aiofiles.os.path.isfile(cache_entry['body_path']):
+        headers['If-None-Match'] = cache_entry['etag']
+    async with semaphore, session.get(url, headers=headers) as req:
+        not_modified = req.status == 304 and 'If-None-Match' in headers
+        if not not_modified:
+            body = await req.read()
+            etag = req.headers.get('ETag')
+            cacheable = req.status == 200 and etag is not None
+    if not_modified:
+        try:
+            async with aiofiles.open(cache_entry['body_path'], 'rb') as body_f:
+                return await body_f.read()
+        except OSError:
+            del etag_cache[url]
+            return await cached_get(session, semaphore, etag_cache, url)
+    if cacheable:
+        body_path = os.path.join(ETAG_CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        async with aiofiles.open(body_path, 'wb') as body_f:
+            await body_f.write(body)
+        etag_cache[url] = {'etag': etag, 'body_path': body_path}
+    return body
+
+async def get_releases_page(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, api_headers: dict, cursor: str, per_page: int):
+    """
+    Retrieves a single page of releases and the name, download url and size of their assets from the GitHub GraphQL API.
+
+    Args:
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+        api_headers (dict): The authenticated GitHub API headers.
+        cursor (str): The cursor to continue after, or None for the first page.
+        per_page (int): The number of releases to retrieve per page.
+
+    Returns:
+        dict: The releases on the page and the page info used to continue pagination.
+
+    Raises:
+        RuntimeError: If the request fails or the response reports GraphQL errors.
     """
-    Compares two version numbers represented as lists of integers.
+    query = {'query': RELEASES_QUERY, 'variables': {'cursor': cursor, 'per_page': per_page}}
+    async with semaphore, session.post('https://api.github.com/graphql', headers={**api_headers, 'Content-Type': 'application/json'}, data=json_dumps(query)) as req:
+        body = await req.read()
+        if req.status != 200:
+            raise RuntimeError(f"GitHub GraphQL request failed with status {req.status}: {body.decode('utf-8', 'replace')}")
+    response = json_loads(body)
+    if response.get('errors') or not response.get('data') or not response['data'].get('repository'):
+        messages = '; '.join(error.get('message', str(error)) for error in response.get('errors') or [])
+        raise RuntimeError(f"GitHub GraphQL query for releases failed: {messages or 'no repository data returned'}")
+    return response['data']['repository']['releases']
+
+async def get_release_manifest(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, etag_cache: dict, release_index: int, url: str):
+    """
+    Downloads and parses the manifest.json asset of a release.
 
     Args:
-        a (list): The first version number.
-        b (list): The second version number.
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+        etag_cache (dict): The ETag cache used for conditional requests.
+        release_index (int): The position of the manifest in the release listing, returned with the content.
+        url (str): The download url of the manifest asset.
 
     Returns:
-        int: -1 if a < b, 0 if a == b, 1 if a > b.
+        tuple: The release index and the manifest content, indexed by platform.
     """
-    for a_sub_version, b_sub_version in zip(a, b):
-        if a_sub_version < b_sub_version:
-            return -1
-        elif a_sub_version > b_sub_version:
-            return 1
-    return 0
-
-async def get_released_boards(session: aiohttp.ClientSession, per_page=30):
+    return release_index, json_loads(await cached_get(session, semaphore, etag_cache, url))
+
+async def get_released_boards(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, etag_cache: dict, api_headers: dict, per_page=100):
     """
     Retrieves the released versions of the Arduino Boards from the GitHub API.
 
+    Releases are listed through the GraphQL API so only the asset fields used are transferred, all of the release
+    manifests are then fetched concurrently and merged as each download completes. Cursor pagination means release
+    pages are fetched one after another, and as a POST the listing can't use the ETag cache.
+
     Args:
-        per_page (int): The number of releases to retrieve per page. Defaults to 30.
+        semaphore (asyncio.Semaphore): Limits the number of requests in flight across all pages and manifests.
+        etag_cache (dict): The ETag cache used for conditional manifest requests.
+        api_headers (dict): The authenticated GitHub API headers, only sent to the API and not to manifest downloads.
+        per_page (int): The number of releases to retrieve per page. Defaults to 100, the GraphQL maximum.
+
+    Draft releases are skipped since the authenticated query lists them but their assets aren't publicly downloadable.
 
     Returns:
         dict: A dictionary containing the released versions of the Arduino Boards, indexed by platform.
     """
     released_versions = defaultdict(dict)
-    page_number = 0
     manifest_content = defaultdict(dict)
+    releases = []
+    cursor = None
     while True:
-        async with session.get('https://api.github.com/repos/AaronLi/Arduino-Boards/releases', headers={"accept": "application/vnd.github+json", 'per_page':str(per_page), 'page':str(page_number), "X-Github-Api-Version": '2022-11-28'}) as req:
-            releases = await req.json()
-            for release in releases:
-                for asset in release['assets']:
-                    if asset['name'] == 'manifest.json':
-                        async with session.get(asset['browser_download_url']) as manifest_req:
-                            release_manifest_content = json.loads(await manifest_req.text())
-                            for platform in release_manifest_content:
-                                version = release_manifest_content[platform]['version']
-                                platform_version = list(map(int, version.split('.')))
-                                manifest_content[platform][version] = {'boards': release_manifest_content[platform]['boards'], 'version': platform_version, 'architecture': release_manifest_content[platform]['architecture']}
-                    else:
-                        version, hash_platform_file = asset['name'].split('_', 1)
-                        hash, platform_file = hash_platform_file.split('_', 1)
-                        platform, extension = platform_file.split('.', 1)
-                        print(f"Version {version} for {platform} filetype {extension} with sha256 {hash}")
-                        released_versions[platform][version] = {"version": list(map(int, version.split('.'))), "url": asset["browser_download_url"], 'filename': asset['name'], 'filesize': asset['size']}
-
-            if len(releases) < per_page:
-                break
-            page_number += 1
+        releases_page = await get_releases_page(session, semaphore, api_headers, cursor, per_page)
+        releases.extend(releases_page['nodes'])
+        if not releases_page['pageInfo']['hasNextPage']:
+            break
+        cursor = releases_page['pageInfo']['endCursor']
+
+    manifest_urls = []
+    for release in releases:
+        if release['isDraft']:
+            continue
+        for asset in release['releaseAssets']['nodes']:
+            if asset['name'] == 'manifest.json':
+                manifest_urls.append(asset['downloadUrl'])
+            else:
+                version, hash, platform_file = asset['name'].split('_', 2)
+                platform, extension = platform_file.split('.', 1)
+                print(f"Version {version} for {platform} filetype {extension} with sha256 {hash}")
+                released_versions[platform][version] = {"version": tuple(map(int, version.split('.'))), "url": asset["downloadUrl"], 'filename': asset['name'], 'filesize': asset['size'], 'sha256': hash, 'extension': extension}
+
+    # Manifests arrive in completion order, keep the one from the latest position in the listing so duplicates
+    # resolve the same way as released_versions
+    manifest_order = defaultdict(dict)
+    manifest_tasks = [asyncio.create_task(get_release_manifest(session, semaphore, etag_cache, release_index, url)) for release_index, url in enumerate(manifest_urls)]
+    try:
+        for release_manifest in asyncio.as_completed(manifest_tasks):
+            release_index, release_manifest_content = await release_manifest
+            for platform in release_manifest_content:
+                version = release_manifest_content[platform]['version']
+                if release_index < manifest_order[platform].get(version, -1):
+                    continue
+                manifest_order[platform][version] = release_index
+                platform_version = tuple(map(int, version.split('.')))
+                manifest_content[platform][version] = {'boards': release_manifest_content[platform]['boards'], 'version': platform_version, 'architecture': release_manifest_content[platform]['architecture']}
+    except BaseException:
+        for manifest_task in manifest_tasks:
+            manifest_task.cancel()
+        await asyncio.gather(*manifest_tasks, return_exceptions=True)
+        raise
     return manifest_content, released_versions
 
+def render_platform_entries(platform_tokens: list, platform_contexts: list):
+    """
+    Renders the platform template once for each platform version.
+
+    Args:
+        platform_tokens (list): The pre-tokenized platform template.
+        platform_contexts (list): The template data for each platform version.
+
+    Returns:
+        list: The rendered platform entries, in the same order as the contexts.
+    """
+    return [chevron.render(platform_tokens, platform_context) for platform_context in platform_contexts]
+
 def create_tag_name():
     return datetime.utcnow().strftime("v%Y-%m-%dT%H%M")
 
@@ -73,7 +227,7 @@ def create_release_title():
 def create_release_body():
     return ""
 
-async def create_release(session: aiohttp.ClientSession, auth_token: str):
+async def create_release(session: aiohttp.ClientSession, api_headers: dict):
     release_body = {
                 "tag_name": create_tag_name(),
                 "draft": True,
@@ -82,22 +236,19 @@ async def create_release(session: aiohttp.ClientSession, auth_token: str):
             }
     async with session.post(
         'https://api.github.com/repos/AaronLi/Arduino-Board-Index/releases',
-          headers={
-              "accept": "application/vnd.github+json",
-               'Authorization': f'Bearer {auth_token}',
-               "X-Github-Api-Version": '2022-11-28'
+            headers={
+                **api_headers,
+                'Content-Type': 'application/json'
             },
-            data=json.dumps(release_body)) as req:
+            data=json_dumps(release_body)) as req:
         response = await req.json()
         return response['id']
 
-async def upload_assets(session: aiohttp.ClientSession, auth_token: str, release_id: str, index_content: str):
+async def upload_assets(session: aiohttp.ClientSession, api_headers: dict, release_id: str, index_content: bytes):
     async with session.post(
                 f'https://uploads.github.com/repos/AaronLi/Arduino-Board-Index/releases/{release_id}/assets?name=package_dumfing_boards_index.json',
                 headers={
-                    "accept": "application/vnd.github+json",
-                    'Authorization': f'Bearer {auth_token}',
-                    "X-Github-Api-Version": '2022-11-28',
+                    **api_headers,
                     'Content-Type': 'application/octet-stream'
                 },
                 data=index_content) as req:
@@ -105,37 +256,51 @@ async def upload_assets(session: aiohttp.ClientSession, auth_token: str, release
         print(response_json['name'], response_json['state'])
 
 async def main():
-    async with aiohttp.ClientSession() as session:
-        async with aiofiles.open(os.path.join('templates', 'package_dmfg_index_template.json.mustache')) as index_f:
-            async with aiofiles.open(os.path.join('templates', 'platform_template.json.mustache')) as platform_f:
-                index_template, platform_template, board_info = await asyncio.gather(index_f.read(), platform_f.read(), get_released_boards(session))
-                manifest_info, released_boards = board_info
-                print(released_boards)
-                print(manifest_info)
-                platform_entries = []
-                for platform in released_boards:
-                    for version in released_boards[platform]:
-                        _, checksum_platform_file = released_boards[platform][version]['filename'].split('_', 1)
-                        checksum, _ = checksum_platform_file.split('_', 1)
-                        platform_info = chevron.render(platform_template, 
-                                    {
-                                            'platform_name': platform,
-                                            'architecture': manifest_info[platform][version]['architecture'],
-                                            'version': version,
-                                            'boards': manifest_info[platform][version]['boards'],
-                                            'url': released_boards[platform][version]['url'],
-                                            'filename': released_boards[platform][version]['filename'],
-                                            'size_bytes': released_boards[platform][version]['filesize'],
-                                            'sha256_checksum': checksum,
-                                    }
-                        )
-                        platform_entries.append(platform_info)
-
-                dmfg_index = chevron.render(index_template, {'platforms': map(lambda x: {'entry': x[1]} if x[0]+1 < len(platform_entries) else {'entry': x[1], 'last': True}, enumerate(platform_entries))})
-                sanity_check = json.loads(dmfg_index)
-                release_id = await create_release(session, os.environ['GH_API_TOKEN'])
-
-                await upload_assets(session, os.environ['GH_API_TOKEN'], release_id, dmfg_index)
+    semaphore = asyncio.Semaphore(10)
+    etag_cache = await load_etag_cache()
+    connector = aiohttp.TCPConnector(limit=50, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+    api_headers = {
+        "accept": "application/vnd.github+json",
+        'Authorization': f'Bearer {os.environ["GH_API_TOKEN"]}',
+        "X-Github-Api-Version": '2022-11-28'
+    }
+    async with aiohttp.ClientSession(connector=connector) as session:
+        index_template, platform_template, board_info = await asyncio.gather(
+            asyncio.to_thread(Path('templates', 'package_dmfg_index_template.json.mustache').read_text),
+            asyncio.to_thread(Path('templates', 'platform_template.json.mustache').read_text),
+            get_released_boards(session, semaphore, etag_cache, api_headers)
+        )
+        await save_etag_cache(etag_cache)
+        manifest_info, released_boards = board_info
+        print(released_boards)
+        print(manifest_info)
+        index_tokens = list(chevron.tokenizer.tokenize(index_template))
+        platform_tokens = list(chevron.tokenizer.tokenize(platform_template))
+        platform_contexts = [
+            {
+                'platform_name': platform,
+                'architecture': manifest_info[platform][version]['architecture'],
+                'version': version,
+                'boards': manifest_info[platform][version]['boards'],
+                'url': released_boards[platform][version]['url'],
+                'filename': released_boards[platform][version]['filename'],
+                'size_bytes': released_boards[platform][version]['filesize'],
+                'sha256_checksum': released_boards[platform][version]['sha256'],
+            }
+            for platform in released_boards
+            for version in released_boards[platform]
+        ]
+
+        platform_entries = await asyncio.to_thread(render_platform_entries, platform_tokens, platform_contexts)
+        platforms = [{'entry': platform_entry} for platform_entry in platform_entries]
+        if platforms:
+            platforms[-1]['last'] = True
+        dmfg_index = (await asyncio.to_thread(chevron.render, index_tokens, {'platforms': platforms})).encode('utf-8')
+        if __debug__:
+            json_loads(dmfg_index)
+        release_id = await create_release(session, api_headers)
+
+        await upload_assets(session, api_headers, release_id, dmfg_index)
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file